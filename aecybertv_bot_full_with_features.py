@@ -6,24 +6,50 @@ python-telegram-bot==21.4
 
 import os
 import re
-import json
+import asyncio
+import atexit
+import bisect
+import gc
+import queue
 import logging
+import logging.handlers
+import mmap
 import sys
+import time
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable, Iterable, Iterator
 
 from zoneinfo import ZoneInfo
 
+try:
+    import orjson  # listed in requirements.txt; stdlib json is the slow fallback
+except ImportError:
+    import json
+    orjson = None
+
+try:
+    import uvloop  # listed in requirements.txt; optional when running locally
+except ImportError:
+    uvloop = None
+
+try:
+    import h2  # httpx[http2]; Bot API calls fall back to HTTP/1.1 without it
+except ImportError:
+    h2 = None
+
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, Contact, InputMediaPhoto
 )
+from telegram.error import BadRequest
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes,
-    MessageHandler, CallbackQueryHandler, filters
+    AIORateLimiter, Application, ApplicationHandlerStop, CommandHandler, ContextTypes,
+    MessageHandler, CallbackQueryHandler, TypeHandler, filters
 )
 
+log = logging.getLogger("aecybertv")
+
 # ------------------------- CONFIG -------------------------
 def env_int(name: str, default: Optional[int] = None) -> Optional[int]:
     v = os.getenv(name)
@@ -37,10 +63,11 @@ def env_int(name: str, default: Optional[int] = None) -> Optional[int]:
 BOT_TOKEN     = os.getenv("BOT_TOKEN")  # required
 ADMIN_CHAT_ID = env_int("ADMIN_CHAT_ID")  # optional
 WEBHOOK_URL   = os.getenv("WEBHOOK_URL")   # optional
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # optional, checked on every webhook POST
 
 if not BOT_TOKEN:
     logging.basicConfig(level=logging.ERROR, format="%(asctime)s - %(levelname)s - %(message)s")
-    logging.error("Missing BOT_TOKEN env var. Set BOT_TOKEN before running.")
+    log.error("Missing BOT_TOKEN env var. Set BOT_TOKEN before running.")
     sys.exit(1)
 
 # ------------------------- TIME/UTILS -------------------------
@@ -52,6 +79,22 @@ def _utcnow() -> datetime:
 def _now_uae() -> datetime:
     return datetime.now(DUBAI_TZ)
 
+# Dubai has no DST, so local time is a fixed offset from UTC; hot paths format
+# their stamps straight from time.time() instead of building aware datetimes.
+_UAE_OFFSET_S = int(DUBAI_TZ.utcoffset(datetime(2000, 1, 1)).total_seconds())
+_UAE_SUFFIX = datetime(2000, 1, 1, tzinfo=DUBAI_TZ).isoformat()[-6:]  # "+04:00"
+
+# Stamps have one-second resolution, so the last one per format is reused
+# until the second changes (bursts of taps then format once).
+_STAMP_CACHE: Dict[str, Tuple[int, str]] = {}
+
+def _uae_stamp(fmt: str = "%Y-%m-%dT%H:%M:%S") -> str:
+    sec = int(time.time())
+    hit = _STAMP_CACHE.get(fmt)
+    if hit is None or hit[0] != sec:
+        hit = _STAMP_CACHE[fmt] = (sec, time.strftime(fmt, time.gmtime(sec + _UAE_OFFSET_S)))
+    return hit[1]
+
 def _parse_iso(ts: str) -> datetime:
     ts = ts.strip()
     if ts.endswith("Z"):
@@ -72,37 +115,230 @@ def dubai_range_to_utc_iso(start_local: datetime, end_local: datetime) -> tuple[
 HISTORY_FILE = Path("customers.jsonl")
 TRIALS_FILE  = Path("trials.jsonl")
 SUPPORT_FILE = Path("support.jsonl")
+STATE_FILE   = Path("state.jsonl")
+LAST_UPDATE_FILE = Path(".last_update")
 
-def save_jsonl(path: Path, obj: dict) -> int:
-    """Append obj to JSONL with an auto ticket id (line number)."""
-    path.touch(exist_ok=True)
-    tid = 0
+# Every record is one compact UTF-8 JSON line. orjson encodes aware datetimes
+# itself; the stdlib fallback writes the same isoformat() text.
+if orjson is not None:
+    def _json_line(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+    _json_loads = orjson.loads
+else:
+    def _json_default(o: Any) -> str:
+        if isinstance(o, datetime):
+            return o.isoformat()
+        raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+    def _json_line(obj: Any) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default) + "\n").encode()
+
+    _json_loads = json.loads
+
+# Ticket ids are line numbers: each file is counted once, then _JSONL_NEXT_ID
+# hands out the following ids and the record itself goes to the background writer.
+_JSONL_NEXT_ID: Dict[Path, int] = {}
+
+def _count_lines(path: Path) -> int:
+    n = 0
     try:
         with path.open("r", encoding="utf-8") as f:
-            for tid, _ in enumerate(f, start=1):
+            for n, _ in enumerate(f, start=1):
                 pass
     except Exception:
-        tid = 0
-    tid = (tid or 0) + 1
-    rec = {"id": tid, **obj}
-    with path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        n = 0
+    return n
+
+def save_jsonl(path: Path, obj: dict) -> int:
+    """Queue obj for JSONL with an auto ticket id (line number); returns the id."""
+    tid = _JSONL_NEXT_ID.get(path)
+    if tid is None:
+        tid = _count_lines(path) + 1
+    _JSONL_NEXT_ID[path] = tid + 1
+    persist_line(path, {"id": tid, **obj})
     return tid
 
-def iter_jsonl(path: Path):
+# Appends (tickets, customer history, state) are queued and written by a single
+# background task that keeps the files open and writes every PERSIST_BATCH
+# records or PERSIST_INTERVAL seconds, whichever comes first. The batch itself
+# is written and fsync'd in a worker thread, so slow disks never stall updates.
+PERSIST_BATCH = 100
+PERSIST_INTERVAL = 1.0
+_PERSIST_Q: Optional[asyncio.Queue] = None
+_PERSIST_TASK: Optional[asyncio.Task] = None
+
+def persist_line(path: Path, obj: dict) -> None:
+    """Queue obj for the background writer (written inline if it is not running)."""
+    line = _json_line(obj)
+    if _PERSIST_Q is None:
+        with path.open("ab") as f:
+            f.write(line)
+        return
+    _PERSIST_Q.put_nowait((path, line))
+
+# Queue items are (path, line) for appends and (path, data, on_done) for
+# rewrites. data is built by the caller on the event loop, so the worker thread
+# only does I/O; on_done(ok) is called back on the loop once the rewrite ran.
+def rewrite_file(path: Path, data: bytes, on_done: Optional[Callable[[bool], None]] = None) -> None:
+    """Replace path with data once everything queued before this call is written."""
+    if _PERSIST_Q is None:
+        ok = _rewrite_file({}, path, data)
+        if on_done is not None:
+            on_done(ok)
+        return
+    _PERSIST_Q.put_nowait((path, data, on_done))
+
+def _rewrite_file(handles: Dict[Path, int], path: Path, data: bytes) -> bool:
+    fd = handles.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with tmp.open("wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return True
+    except Exception as e:
+        log.error("Failed to rewrite %s: %s", path, e)
+        return False
+
+# The writer appends through raw O_APPEND descriptors with one writev() per file
+# per batch, so a batch costs one syscall per file and no user-space join/copy.
+WRITEV_MAX_IOV = 512
+
+_HAS_WRITEV = hasattr(os, "writev")  # not available on Windows
+
+def _write_all(fd: int, lines: List[bytes]) -> None:
+    for i in range(0, len(lines), WRITEV_MAX_IOV):
+        chunk = lines[i:i + WRITEV_MAX_IOV]
+        n = os.writev(fd, chunk) if _HAS_WRITEV else os.write(fd, b"".join(chunk))
+        if n < sum(map(len, chunk)):  # short write: finish the remainder
+            rest = memoryview(b"".join(chunk))[n:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+def _append_lines(handles: Dict[Path, int], path: Path, lines: List[bytes]) -> None:
+    try:
+        fd = handles.get(path)
+        if fd is None:
+            fd = handles[path] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        _write_all(fd, lines)
+        os.fsync(fd)
+    except Exception as e:
+        log.error("Failed to write %s: %s", path, e)
+
+def _write_batch(handles: Dict[Path, int], batch: List[tuple]) -> List[Tuple[Callable[[bool], None], bool]]:
+    """Write a batch in order; returns the rewrite callbacks for the loop to run."""
+    by_path: Dict[Path, List[bytes]] = {}
+    done: List[Tuple[Callable[[bool], None], bool]] = []
+    for entry in batch:
+        path = entry[0]
+        if len(entry) == 3:
+            pending = by_path.pop(path, None)
+            if pending:
+                _append_lines(handles, path, pending)
+            ok = _rewrite_file(handles, path, entry[1])
+            if entry[2] is not None:
+                done.append((entry[2], ok))
+        else:
+            by_path.setdefault(path, []).append(entry[1])
+    for path, lines in by_path.items():
+        _append_lines(handles, path, lines)
+    return done
+
+def _run_done(done: List[Tuple[Callable[[bool], None], bool]]) -> None:
+    for cb, ok in done:
+        try:
+            cb(ok)
+        except Exception as e:
+            log.error("Rewrite callback failed: %s", e)
+
+async def collect_batch(q: asyncio.Queue, max_items: int, window: float) -> Tuple[list, bool]:
+    """Wait for one item, then take more until max_items or window seconds pass.
+
+    Returns (batch, stop); stop is True once the None sentinel was seen.
+    """
+    loop = asyncio.get_running_loop()
+    item = await q.get()
+    if item is None:
+        return [], True
+    batch = [item]
+    deadline = loop.time() + window
+    while len(batch) < max_items:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(q.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+async def _persist_flusher(q: asyncio.Queue) -> None:
+    handles: Dict[Path, int] = {}
+    try:
+        while True:
+            batch, stop = await collect_batch(q, PERSIST_BATCH, PERSIST_INTERVAL)
+            _run_done(await asyncio.to_thread(_write_batch, handles, batch))
+            if stop:
+                return
+    finally:
+        _drain(q, handles)
+
+def _drain(q: asyncio.Queue, handles: Dict[Path, int]) -> None:
+    rest = []
+    while not q.empty():
+        item = q.get_nowait()
+        if item is not None:
+            rest.append(item)
+    _run_done(_write_batch(handles, rest))
+    for fd in handles.values():
+        os.close(fd)
+    handles.clear()
+
+def start_persist_writer() -> None:
+    global _PERSIST_Q, _PERSIST_TASK
+    _PERSIST_Q = asyncio.Queue()
+    _PERSIST_TASK = asyncio.create_task(_persist_flusher(_PERSIST_Q))
+
+async def stop_persist_writer() -> None:
+    """Stop the writer; it drains anything still queued before closing files."""
+    global _PERSIST_Q, _PERSIST_TASK
+    if _PERSIST_TASK is None:
+        return
+    # A None sentinel rather than cancel(): on 3.11 wait_for() can swallow a
+    # cancellation that races with q.get(), leaving the writer running.
+    _PERSIST_Q.put_nowait(None)
+    try:
+        await _PERSIST_TASK
+    except Exception as e:
+        log.error("Persist writer failed: %s", e)
+    _PERSIST_Q = _PERSIST_TASK = None
+
+# Records are yielded one at a time. Small files are read in one go; larger ones
+# are mapped and walked with mmap.readline, so only the current line is copied.
+MMAP_MIN_BYTES = 64 * 1024
+
+def _parse_lines(lines: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    for line in lines:
+        try:
+            yield _json_loads(line)  # surrounding whitespace is valid JSON
+        except Exception:
+            continue  # blank or corrupt line
+
+def iter_jsonl(path: Path) -> Iterator[Dict[str, Any]]:
     if not path.exists():
-        return []
-    items = []
-    with path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                items.append(json.loads(line))
-            except Exception:
-                continue
-    return items
+        return
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_MIN_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from _parse_lines(iter(mm.readline, b""))
+        else:
+            yield from _parse_lines(f.read().splitlines())
 
 # ------------------------- PACKAGES -------------------------
 PACKAGES: Dict[str, Dict[str, Any]] = {
@@ -233,51 +469,241 @@ def build_embedded_offers() -> List[Dict[str, Any]]:
         "start_at": s, "end_at": e, "priority": 100
     })
 
+    # Parse the window once here; request-time checks compare datetimes directly.
+    # Title/body are also keyed by language so renderers index instead of branching.
+    for o in offers:
+        o["_title"] = {"ar": o["title_ar"], "en": o["title_en"]}
+        o["_body"] = {"ar": o["body_ar"], "en": o["body_en"]}
+        o["_start_dt"] = _parse_iso(o["start_at"])
+        o["_end_dt"] = _parse_iso(o["end_at"])
+        o["_window_uae"] = (f"{o['_start_dt'].astimezone(DUBAI_TZ):%Y-%m-%d %H:%M:%S} → "
+                            f"{o['_end_dt'].astimezone(DUBAI_TZ):%Y-%m-%d %H:%M:%S}")
     return offers
 
+def _offer_fields(offers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Offers without the derived underscore fields, for change detection."""
+    return [{k: v for k, v in o.items() if not k.startswith("_")} for o in offers]
+
+# Offers sorted by start and by end (with parallel key lists for bisect) plus a
+# display-ordered copy; rebuilt whenever OFFERS_ALL is replaced.
+_OFFER_INDEX: Dict[str, Any] = {}
+
+def _offer_index() -> Dict[str, Any]:
+    if _OFFER_INDEX.get("src") is not OFFERS_ALL:
+        by_start = sorted(OFFERS_ALL, key=lambda o: o["_start_dt"])
+        by_end = sorted(OFFERS_ALL, key=lambda o: o["_end_dt"])
+        _OFFER_INDEX.update(
+            src=OFFERS_ALL,
+            by_start=by_start, starts=[o["_start_dt"] for o in by_start],
+            by_end=by_end, ends=[o["_end_dt"] for o in by_end],
+            ranked=sorted(OFFERS_ALL, key=lambda x: (-(int(x.get("priority", 0))), x.get("start_at", ""))),
+        )
+    return _OFFER_INDEX
+
+# The active set only changes when an offer starts or ends, so the last answer
+# is reused until the next such boundary (rather than for a fixed TTL, which
+# could keep showing an expired offer).
+_ACTIVE_CACHE: Dict[str, Any] = {}
+
 def active_offers(now: Optional[datetime] = None) -> List[Dict[str, Any]]:
     if now is None:
         now = _utcnow()  # UTC
-    acts: List[Dict[str, Any]] = []
-    for o in OFFERS_ALL:
-        try:
-            if _parse_iso(o["start_at"]) <= now <= _parse_iso(o["end_at"]):
-                acts.append(o)
-        except Exception:
-            continue
-    acts.sort(key=lambda x: (-(int(x.get("priority", 0))), x.get("start_at", "")))
-    return acts
+    ix = _offer_index()
+    c = _ACTIVE_CACHE
+    if c.get("src") is OFFERS_ALL and c["since"] <= now < c["next_start"] and now <= c["next_end"]:
+        return c["val"]
+    n_started = bisect.bisect_right(ix["starts"], now)
+    i_end = bisect.bisect_left(ix["ends"], now)
+    started = {id(o) for o in ix["by_start"][:n_started]}
+    live = {id(o) for o in ix["by_end"][i_end:] if id(o) in started}
+    val = [o for o in ix["ranked"] if id(o) in live]
+    _ACTIVE_CACHE.update(
+        src=OFFERS_ALL, val=val, since=now,
+        next_start=ix["starts"][n_started] if n_started < len(ix["starts"]) else datetime.max.replace(tzinfo=timezone.utc),
+        next_end=ix["ends"][i_end] if i_end < len(ix["ends"]) else datetime.max.replace(tzinfo=timezone.utc),
+    )
+    return val
 
 def upcoming_offers(now: Optional[datetime] = None) -> List[Dict[str, Any]]:
     if now is None:
         now = _utcnow()  # UTC
-    ups: List[Dict[str, Any]] = []
-    for o in OFFERS_ALL:
-        try:
-            if now < _parse_iso(o["start_at"]):
-                ups.append(o)
-        except Exception:
-            continue
-    ups.sort(key=lambda x: x.get("start_at", ""))
-    return ups
+    ix = _offer_index()
+    return ix["by_start"][bisect.bisect_right(ix["starts"], now):]
 
 # ------------------------- STATE -------------------------
 USER_STATE: Dict[int, Dict[str, Any]] = {}
+# Language is read on every render (t(), keyboards), so it is also kept in a flat
+# chat_id -> lang map; set_state() and load_state() keep the two in step.
+CHAT_LANG: Dict[int, str] = {}
 PHONE_RE = re.compile(r"^\+?\d[\d\s\-()]{6,}$")
+_PHONE_JUNK_RE = re.compile(r"[^\d+]")
 
 def normalize_phone(s: str) -> str:
     s = s.strip()
     if s.startswith("00"):
         s = "+" + s[2:]
-    return re.sub(r"[^\d+]", "", s)
+    return _PHONE_JUNK_RE.sub("", s)
+
+# set_state() only marks the chat dirty; every STATE_FLUSH_INTERVAL seconds the
+# dirty chats are appended to STATE_FILE (one line each, however many changes
+# they had) and load_state() replays the log on startup. After
+# STATE_COMPACT_EVERY lines the log is rewritten as one line per chat so replay
+# time tracks the number of chats, not their history.
+STATE_FLUSH_INTERVAL = 5.0
+STATE_COMPACT_EVERY = 5000
+_STATE_DIRTY: set = set()
+_STATE_LINES = 0
+_STATE_COMPACTING = False
+_STATE_TASK: Optional[asyncio.Task] = None
+
+def _state_snapshot() -> bytes:
+    return b"".join(_json_line({"chat_id": cid, "patch": st}) for cid, st in USER_STATE.items())
+
+def _compact_state() -> None:
+    """Queue a rewrite of STATE_FILE from USER_STATE as it is right now.
+
+    The snapshot is built here, so it lands in order with the patch lines queued
+    before and after it. The line count is only reduced once the rewrite has
+    succeeded; a failed one is retried on the next flush.
+    """
+    global _STATE_COMPACTING
+    counted = _STATE_LINES
+
+    def done(ok: bool) -> None:
+        global _STATE_LINES, _STATE_COMPACTING
+        _STATE_COMPACTING = False
+        if ok:
+            _STATE_LINES -= counted
+
+    _STATE_COMPACTING = True
+    rewrite_file(STATE_FILE, _state_snapshot(), done)
+
+# Keys and enum-like values parsed from the log are interned so they are the same
+# objects as the literals in the code and dict lookups hit the identity check.
+_INTERN_FIELDS = frozenset({"lang", "flow", "awaiting_phone_reason", "awaiting_username_reason"})
+
+def _intern_patch(patch: Dict[str, Any]) -> Dict[str, Any]:
+    return {sys.intern(k): (sys.intern(v) if k in _INTERN_FIELDS and isinstance(v, str) else v)
+            for k, v in patch.items()}
+
+def load_state() -> None:
+    """Rebuild USER_STATE from the state log and compact it."""
+    for rec in iter_jsonl(STATE_FILE):
+        try:
+            USER_STATE.setdefault(int(rec["chat_id"]), {}).update(_intern_patch(rec["patch"]))
+        except Exception:
+            continue
+    CHAT_LANG.update((cid, st["lang"]) for cid, st in USER_STATE.items() if "lang" in st)
+    if USER_STATE:
+        _compact_state()
+    log.info("Loaded state for %s chats", len(USER_STATE))
+
+def flush_state() -> None:
+    global _STATE_LINES
+    if not _STATE_DIRTY:
+        return
+    dirty = list(_STATE_DIRTY)
+    _STATE_DIRTY.clear()
+    try:
+        for cid in dirty:
+            persist_line(STATE_FILE, {"chat_id": cid, "patch": USER_STATE.get(cid, {})})
+    except Exception as e:
+        log.error("Failed to write state.jsonl: %s", e)
+    _STATE_LINES += len(dirty)
+    if _STATE_LINES >= STATE_COMPACT_EVERY and not _STATE_COMPACTING:
+        _compact_state()
+
+async def _state_flusher() -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        flush_state()
+
+def start_state_flusher() -> None:
+    global _STATE_TASK
+    _STATE_TASK = asyncio.create_task(_state_flusher())
+
+async def stop_state_flusher() -> None:
+    """Stop the periodic flush and write whatever is still dirty."""
+    global _STATE_TASK
+    if _STATE_TASK is not None:
+        _STATE_TASK.cancel()
+        try:
+            await _STATE_TASK
+        except asyncio.CancelledError:
+            pass
+        _STATE_TASK = None
+    flush_state()
 
 def set_state(chat_id: int, **kv):
     st = USER_STATE.setdefault(chat_id, {})
     st.update(kv)
+    if "lang" in kv:
+        CHAT_LANG[chat_id] = kv["lang"]
+    _STATE_DIRTY.add(chat_id)
 
 def get_state(chat_id: int) -> Dict[str, Any]:
     return USER_STATE.get(chat_id, {})
 
+def get_lang(chat_id: int) -> str:
+    return CHAT_LANG.get(chat_id, "ar")
+
+# Buttons with side effects (tickets, breadcrumbs, admin pings) ignore an identical
+# press from the same chat inside this window; users double-tap a lot.
+CALLBACK_DEDUP_TTL = 3.0
+CALLBACK_DEDUP_PREFIXES = frozenset({"pkg", "agree", "paid", "trial_pkg", "support_issue", "offer_paid"})
+_SEEN_CALLBACKS: Dict[Tuple[int, str], float] = {}
+
+def seen_recently(chat_id: int, data: str) -> bool:
+    """True if this exact callback was already handled for the chat within the TTL."""
+    now = time.monotonic()
+    key = (chat_id, data)
+    last = _SEEN_CALLBACKS.get(key)
+    if last is not None and now - last < CALLBACK_DEDUP_TTL:
+        return True
+    if len(_SEEN_CALLBACKS) >= 1024:
+        for k in [k for k, ts in _SEEN_CALLBACKS.items() if now - ts >= CALLBACK_DEDUP_TTL]:
+            del _SEEN_CALLBACKS[k]
+    _SEEN_CALLBACKS[key] = now
+    return False
+
+# Pending updates are no longer dropped on restart, so after a crash polling gets
+# back the last getUpdates batch, handled or not. The highest update_id handled
+# is appended to LAST_UPDATE_FILE (compacted every UPDATE_COMPACT_EVERY lines);
+# at startup it becomes the checkpoint and anything at or below it is skipped.
+UPDATE_COMPACT_EVERY = 5000
+_UPDATE_CHECKPOINT = 0
+_LAST_UPDATE_ID = 0
+_UPDATE_LINES = 0
+
+def load_update_checkpoint() -> None:
+    """Read the last handled update_id of the previous run and compact the file."""
+    global _UPDATE_CHECKPOINT, _LAST_UPDATE_ID
+    for rec in iter_jsonl(LAST_UPDATE_FILE):
+        try:
+            _UPDATE_CHECKPOINT = max(_UPDATE_CHECKPOINT, int(rec["update_id"]))
+        except Exception:
+            continue
+    _LAST_UPDATE_ID = _UPDATE_CHECKPOINT
+    if _UPDATE_CHECKPOINT:
+        rewrite_file(LAST_UPDATE_FILE, _json_line({"update_id": _UPDATE_CHECKPOINT}))
+        log.info("Skipping updates up to id %s", _UPDATE_CHECKPOINT)
+
+async def skip_seen_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _LAST_UPDATE_ID, _UPDATE_LINES
+    uid = update.update_id
+    if uid <= _UPDATE_CHECKPOINT:
+        raise ApplicationHandlerStop
+    if uid <= _LAST_UPDATE_ID:
+        return
+    _LAST_UPDATE_ID = uid
+    _UPDATE_LINES += 1
+    if _UPDATE_LINES >= UPDATE_COMPACT_EVERY:
+        # A failed rewrite loses nothing: the appended lines are still there.
+        _UPDATE_LINES = 0
+        rewrite_file(LAST_UPDATE_FILE, _json_line({"update_id": uid}))
+    else:
+        persist_line(LAST_UPDATE_FILE, {"update_id": uid})
+
 def save_customer(chat_id: int, user, package: Optional[str], phone: Optional[str], extra: Optional[dict]=None) -> None:
     rec = {
         "chat_id": chat_id,
@@ -286,15 +712,42 @@ def save_customer(chat_id: int, user, package: Optional[str], phone: Optional[st
         "name": user.full_name,
         "package": package,
         "phone": phone,
-        "ts": _now_uae().isoformat(timespec="seconds"),
+        "ts": _uae_stamp() + _UAE_SUFFIX,
     }
     if extra:
         rec.update(extra)
     try:
-        with HISTORY_FILE.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        persist_line(HISTORY_FILE, rec)
     except Exception as e:
-        logging.error("Failed to write customers.jsonl: %s", e)
+        log.error("Failed to write customers.jsonl: %s", e)
+
+# Latest trial per (phone, package). Built from trials.jsonl at startup (or on
+# first use) and kept current by record_trial(), so the cooldown check never
+# rescans the file.
+_TRIAL_LAST: Optional[Dict[Tuple[str, str], datetime]] = None
+
+def _trial_index() -> Dict[Tuple[str, str], datetime]:
+    global _TRIAL_LAST
+    if _TRIAL_LAST is None:
+        idx: Dict[Tuple[str, str], datetime] = {}
+        for r in iter_jsonl(TRIALS_FILE):
+            try:
+                when = datetime.fromisoformat(r.get("created_at"))
+            except Exception:
+                when = _now_uae()
+            key = (r.get("phone"), r.get("package"))
+            if key not in idx or when > idx[key]:
+                idx[key] = when
+        _TRIAL_LAST = idx
+    return _TRIAL_LAST
+
+def last_trial(phone: str, pkg: str) -> Optional[datetime]:
+    return _trial_index().get((phone, pkg))
+
+def record_trial(phone: str, pkg: str, when: datetime) -> None:
+    idx = _trial_index()
+    if (phone, pkg) not in idx or when > idx[phone, pkg]:
+        idx[phone, pkg] = when
 
 # ------------------------- I18N -------------------------
 BRAND = "AECyberTV"
@@ -503,86 +956,201 @@ I18N = {
     "support_saved": {"ar": "✅ تم تسجيل البلاغ وسنتواصل معك قريبًا.", "en": "✅ Your support ticket is recorded. We will contact you soon."},
 }
 
+SUPPORTED_LANGS = ("ar", "en")
+
+# Flattened per-language tables, built once so t() is a plain two-dict lookup.
+STRINGS: Dict[str, Dict[str, str]] = {
+    lang: {key: (val.get(lang, val.get("en", "")) if isinstance(val, dict) else str(val))
+           for key, val in I18N.items()}
+    for lang in SUPPORTED_LANGS
+}
+
 def t(chat_id: int, key: str) -> str:
-    lang = get_state(chat_id).get("lang", "ar")
-    val = I18N.get(key)
-    if isinstance(val, dict):
-        return val.get(lang, val.get("en", ""))
-    return str(val)
+    return STRINGS[get_lang(chat_id)].get(key, "")
 
 # ------------------------- KEYBOARDS -------------------------
-def lang_kb() -> InlineKeyboardMarkup:
+# Static keyboards depend only on the language (or nothing at all), so they are
+# built once at import and shared; per-package ones are memoised on first use.
+def _build_lang_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(I18N["lang_ar"]["ar"], callback_data="lang|ar"),
          InlineKeyboardButton(I18N["lang_en"]["en"], callback_data="lang|en")]
     ])
 
-def main_menu_kb(chat_id: int) -> InlineKeyboardMarkup:
+def _build_main_menu_kb(lang: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(chat_id, "btn_more_info"), callback_data="more_info"),
-         InlineKeyboardButton(t(chat_id, "btn_subscribe"), callback_data="subscribe")],
-        [InlineKeyboardButton(t(chat_id, "btn_renew"), callback_data="renew"),
-         InlineKeyboardButton(t(chat_id, "btn_trial"), callback_data="trial")],
-        [InlineKeyboardButton(t(chat_id, "btn_support"), callback_data="support"),
-         InlineKeyboardButton(t(chat_id, "btn_offers"), callback_data="offers")]
+        [InlineKeyboardButton(s["btn_more_info"], callback_data="more_info"),
+         InlineKeyboardButton(s["btn_subscribe"], callback_data="subscribe")],
+        [InlineKeyboardButton(s["btn_renew"], callback_data="renew"),
+         InlineKeyboardButton(s["btn_trial"], callback_data="trial")],
+        [InlineKeyboardButton(s["btn_support"], callback_data="support"),
+         InlineKeyboardButton(s["btn_offers"], callback_data="offers")]
     ])
 
-def more_info_summary_kb(chat_id: int) -> InlineKeyboardMarkup:
+def _build_more_info_summary_kb(lang: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(chat_id, "btn_players_links"), callback_data="players_links")],
-        [InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")]
+        [InlineKeyboardButton(s["btn_players_links"], callback_data="players_links")],
+        [InlineKeyboardButton(s["btn_back"], callback_data="back_home")]
     ])
 
-def players_links_kb(chat_id: int) -> InlineKeyboardMarkup:
+def _build_players_links_kb(lang: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(chat_id, "btn_player_iplay"), callback_data="player_links|iplay")],
-        [InlineKeyboardButton(t(chat_id, "btn_player_splayer"), callback_data="player_links|splayer")],
-        [InlineKeyboardButton(t(chat_id, "btn_player_000"), callback_data="player_links|000")],
-        [InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="more_info")]
+        [InlineKeyboardButton(s["btn_player_iplay"], callback_data="player_links|iplay")],
+        [InlineKeyboardButton(s["btn_player_splayer"], callback_data="player_links|splayer")],
+        [InlineKeyboardButton(s["btn_player_000"], callback_data="player_links|000")],
+        [InlineKeyboardButton(s["btn_back"], callback_data="more_info")]
     ])
 
-def packages_kb() -> InlineKeyboardMarkup:
+def _build_support_issues_kb(lang: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
+    rows = [[InlineKeyboardButton(s["support_login"], callback_data="support_issue|login")],
+            [InlineKeyboardButton(s["support_buffer"], callback_data="support_issue|buffer")],
+            [InlineKeyboardButton(s["support_channels"], callback_data="support_issue|channels")],
+            [InlineKeyboardButton(s["support_billing"], callback_data="support_issue|billing")],
+            [InlineKeyboardButton(s["support_other"], callback_data="support_issue|other")],
+            [InlineKeyboardButton(s["btn_back"], callback_data="back_home")]]
+    return InlineKeyboardMarkup(rows)
+
+def _build_back_home_kb(lang: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(STRINGS[lang]["btn_back"], callback_data="back_home")]])
+
+def _build_packages_kb() -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(pkg, callback_data=f"pkg|{pkg}")] for pkg in PACKAGES.keys()]
     rows.append([InlineKeyboardButton("⬅️ Back", callback_data="back_home")])
     return InlineKeyboardMarkup(rows)
 
-def agree_kb(chat_id: int, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+def _build_trial_packages_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(f"{pkg} — {PACKAGES[pkg]['trial_hours']}h", callback_data=f"trial_pkg|{pkg}")]
+            for pkg in PACKAGES.keys()]
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data="back_home")])
+    return InlineKeyboardMarkup(rows)
+
+LANG_KB = _build_lang_kb()
+PACKAGES_KB = _build_packages_kb()
+TRIAL_PACKAGES_KB = _build_trial_packages_kb()
+
+KB_CACHE: Dict[Tuple[str, str], InlineKeyboardMarkup] = {}
+for _lang in SUPPORTED_LANGS:
+    KB_CACHE["main", _lang] = _build_main_menu_kb(_lang)
+    KB_CACHE["more_info", _lang] = _build_more_info_summary_kb(_lang)
+    KB_CACHE["players_links", _lang] = _build_players_links_kb(_lang)
+    KB_CACHE["support_issues", _lang] = _build_support_issues_kb(_lang)
+    KB_CACHE["back_home", _lang] = _build_back_home_kb(_lang)
+
+def lang_kb() -> InlineKeyboardMarkup:
+    return LANG_KB
+
+def main_menu_kb(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_CACHE["main", get_lang(chat_id)]
+
+def more_info_summary_kb(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_CACHE["more_info", get_lang(chat_id)]
+
+def players_links_kb(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_CACHE["players_links", get_lang(chat_id)]
+
+def support_issues_kb(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_CACHE["support_issues", get_lang(chat_id)]
+
+def back_home_kb(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_CACHE["back_home", get_lang(chat_id)]
+
+def packages_kb() -> InlineKeyboardMarkup:
+    return PACKAGES_KB
+
+def trial_packages_kb() -> InlineKeyboardMarkup:
+    return TRIAL_PACKAGES_KB
+
+def _build_agree_kb(lang: str, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(chat_id, "btn_agree"), callback_data=f"agree|{reason}|{pkg_name}")],
-        [InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")],
+        [InlineKeyboardButton(s["btn_agree"], callback_data=f"agree|{reason}|{pkg_name}")],
+        [InlineKeyboardButton(s["btn_back"], callback_data="back_home")],
     ])
 
-def pay_kb(chat_id: int, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+def _build_pay_kb(lang: str, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+    s = STRINGS[lang]
     pay_url = PACKAGES[pkg_name]["payment_url"]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(chat_id, "btn_pay_now"), url=pay_url)],
-        [InlineKeyboardButton(t(chat_id, "btn_paid"), callback_data=f"paid|{reason}|{pkg_name}")],
-        [InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")],
+        [InlineKeyboardButton(s["btn_pay_now"], url=pay_url)],
+        [InlineKeyboardButton(s["btn_paid"], callback_data=f"paid|{reason}|{pkg_name}")],
+        [InlineKeyboardButton(s["btn_back"], callback_data="back_home")],
     ])
 
-def trial_packages_kb() -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(f"{pkg} — {PACKAGES[pkg]['trial_hours']}h", callback_data=f"trial_pkg|{pkg}")]
-            for pkg in PACKAGES.keys()]
-    rows.append([InlineKeyboardButton("⬅️ Back", callback_data="back_home")])
-    return InlineKeyboardMarkup(rows)
+# Only the known flows are memoised so a forged callback payload cannot grow the cache.
+KB_FLOWS = ("subscribe", "renew")
+PKG_KB_CACHE: Dict[Tuple[str, str, str, str], InlineKeyboardMarkup] = {}
+
+def _pkg_kb(kind: str, build: Callable[[str, str, str], InlineKeyboardMarkup],
+            chat_id: int, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+    lang = get_lang(chat_id)
+    if reason not in KB_FLOWS or pkg_name not in PACKAGES:
+        return build(lang, pkg_name, reason)
+    key = (kind, lang, pkg_name, reason)
+    kb = PKG_KB_CACHE.get(key)
+    if kb is None:
+        kb = PKG_KB_CACHE[key] = build(lang, pkg_name, reason)
+    return kb
 
-def support_issues_kb(chat_id: int) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(t(chat_id, "support_login"), callback_data="support_issue|login")],
-            [InlineKeyboardButton(t(chat_id, "support_buffer"), callback_data="support_issue|buffer")],
-            [InlineKeyboardButton(t(chat_id, "support_channels"), callback_data="support_issue|channels")],
-            [InlineKeyboardButton(t(chat_id, "support_billing"), callback_data="support_issue|billing")],
-            [InlineKeyboardButton(t(chat_id, "support_other"), callback_data="support_issue|other")],
-            [InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")]]
-    return InlineKeyboardMarkup(rows)
+def agree_kb(chat_id: int, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+    return _pkg_kb("agree", _build_agree_kb, chat_id, pkg_name, reason)
 
-def phone_request_kb(chat_id: int) -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton(t(chat_id, "btn_share_phone"), request_contact=True)]],
+def pay_kb(chat_id: int, pkg_name: str, reason: str) -> InlineKeyboardMarkup:
+    return _pkg_kb("pay", _build_pay_kb, chat_id, pkg_name, reason)
+
+PHONE_KB: Dict[str, ReplyKeyboardMarkup] = {
+    _lang: ReplyKeyboardMarkup(
+        [[KeyboardButton(STRINGS[_lang]["btn_share_phone"], request_contact=True)]],
         resize_keyboard=True, one_time_keyboard=True, input_field_placeholder="Tap to share, or type your number…"
     )
+    for _lang in SUPPORTED_LANGS
+}
+
+def phone_request_kb(chat_id: int) -> ReplyKeyboardMarkup:
+    return PHONE_KB[get_lang(chat_id)]
+
+REMOVE_KB = ReplyKeyboardRemove()
+
+# Offer keyboards depend only on the offer index / the active set and language.
+# They are memoised too; out-of-range indexes (stale or forged callbacks) are
+# built but not cached.
+OFFER_KB_CACHE: Dict[Any, InlineKeyboardMarkup] = {}
+
+def offers_list_kb(lang: str, acts: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    key = (lang, tuple(o["id"] for o in acts))
+    kb = OFFER_KB_CACHE.get(key)
+    if kb is None:
+        rows = [[InlineKeyboardButton(o["_title"][lang], callback_data=f"offer_act|{idx}")] for idx, o in enumerate(acts)]
+        rows.append([InlineKeyboardButton(STRINGS[lang]["btn_back"], callback_data="back_home")])
+        kb = OFFER_KB_CACHE[key] = InlineKeyboardMarkup(rows)
+    return kb
 
-# Offer package selection keyboard
 def offer_packages_kb(idx: int) -> InlineKeyboardMarkup:
+    kb = OFFER_KB_CACHE.get(idx)
+    if kb is None:
+        kb = _build_offer_packages_kb(idx)
+        if 0 <= idx < len(OFFERS_ALL):
+            OFFER_KB_CACHE[idx] = kb
+    return kb
+
+def offer_pay_kb(off: Dict[str, Any], idx: int, pkg_key: str, lang: str) -> InlineKeyboardMarkup:
+    """Pay/paid keyboard for a package with a CTA url; memoised on the offer dict."""
+    cache = off.setdefault("_pay_kb", {})
+    key = (lang, idx, pkg_key)
+    kb = cache.get(key)
+    if kb is None:
+        s = STRINGS[lang]
+        kb = cache[key] = InlineKeyboardMarkup([
+            [InlineKeyboardButton(s["btn_pay_now"], url=off["cta_urls"][pkg_key])],
+            [InlineKeyboardButton(s["btn_paid"], callback_data=f"offer_paid|{idx}|{pkg_key}")],
+            [InlineKeyboardButton("⬅️ Back", callback_data=f"offer_act|{idx}")]
+        ])
+    return kb
+
+def _build_offer_packages_kb(idx: int) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("Casual", callback_data=f"offer_pkg|{idx}|Casual"),
          InlineKeyboardButton("Executive", callback_data=f"offer_pkg|{idx}|Executive")],
@@ -593,29 +1161,146 @@ def offer_packages_kb(idx: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 # ------------------------- HELPERS -------------------------
+# Last (message_id, text, markup) each chat's callback message was edited to.
+# Re-rendering identical content is skipped: Telegram rejects it as "message is
+# not modified", which used to cost a round-trip plus a duplicate fallback send.
+# Only the LAST_MSG_MAX most recently edited chats are remembered.
+LAST_MSG_MAX = 4096
+LAST_MSG: Dict[int, Tuple[int, str, Optional[InlineKeyboardMarkup]]] = {}
+
+def _remember_render(chat_id: int, rendered: Tuple[int, str, Optional[InlineKeyboardMarkup]]) -> None:
+    LAST_MSG.pop(chat_id, None)
+    LAST_MSG[chat_id] = rendered
+    if len(LAST_MSG) > LAST_MSG_MAX:
+        del LAST_MSG[next(iter(LAST_MSG))]
+
 async def safe_edit_or_send(query, context, chat_id: int, text: str,
                             kb, html: bool = False, no_preview: bool = False) -> None:
-    """Edits callback message OR sends new message. If kb is ReplyKeyboardMarkup, send only a new message."""
+    """Edits callback message OR sends new message. If kb is ReplyKeyboardMarkup, send only a new message.
+
+    Only a BadRequest from the edit (message gone, not editable) falls back to a
+    fresh message; rate limits and network errors propagate to PTB.
+    """
+    if isinstance(kb, ReplyKeyboardMarkup):
+        await context.bot.send_message(
+            chat_id=chat_id, text=text, reply_markup=kb,
+            parse_mode="HTML" if html else None, disable_web_page_preview=no_preview
+        )
+        return
+    markup = kb if isinstance(kb, InlineKeyboardMarkup) else None
+    rendered = (query.message.message_id, text, markup)
+    if LAST_MSG.get(chat_id) == rendered:
+        return
+    # Recorded before the edit so a concurrent update rendering the same content
+    # skips it. If another edit starts meanwhile, the two may land in either
+    # order, so the entry is dropped rather than trusted.
+    _remember_render(chat_id, rendered)
     try:
-        if isinstance(kb, ReplyKeyboardMarkup):
-            await context.bot.send_message(
-                chat_id=chat_id, text=text, reply_markup=kb,
-                parse_mode="HTML" if html else None, disable_web_page_preview=no_preview
-            )
-        else:
-            await query.edit_message_text(
-                text, reply_markup=kb if isinstance(kb, InlineKeyboardMarkup) else None,
-                parse_mode="HTML" if html else None, disable_web_page_preview=no_preview,
-            )
-    except Exception as e:
-        logging.warning("safe_edit_or_send fallback: %s", e)
+        await query.edit_message_text(
+            text, reply_markup=markup,
+            parse_mode="HTML" if html else None, disable_web_page_preview=no_preview,
+        )
+    except BadRequest as e:
+        if "not modified" in e.message.lower():
+            if LAST_MSG.get(chat_id) != rendered:
+                LAST_MSG.pop(chat_id, None)
+            return
+        LAST_MSG.pop(chat_id, None)
+        log.warning("safe_edit_or_send fallback: %s", e)
         try:
             await context.bot.send_message(
                 chat_id=chat_id, text=text, reply_markup=kb,
                 parse_mode="HTML" if html else None, disable_web_page_preview=no_preview
             )
         except Exception as e2:
-            logging.error("send_message failed: %s", e2)
+            log.error("send_message failed: %s", e2)
+    except Exception:
+        LAST_MSG.pop(chat_id, None)
+        raise
+    else:
+        if LAST_MSG.get(chat_id) != rendered:
+            LAST_MSG.pop(chat_id, None)
+
+# Admin notifications are queued and sent by one background task so handlers
+# never wait on them; whatever arrives within ADMIN_COALESCE_WINDOW is joined
+# into one message (at most ADMIN_COALESCE_MAX, split at Telegram's length cap).
+# A notification with screenshots is not joined, so its photos follow its text.
+ADMIN_COALESCE_WINDOW = 0.5
+ADMIN_COALESCE_MAX = 10
+ADMIN_MSG_LIMIT = 4096
+_ADMIN_Q: Optional[asyncio.Queue] = None
+_ADMIN_TASK: Optional[asyncio.Task] = None
+
+def notify_admin(text: str, pics: Optional[List[str]] = None) -> None:
+    """Queue a message (and optional screenshots) for the admin chat."""
+    if not ADMIN_CHAT_ID:
+        return
+    if _ADMIN_Q is None:
+        log.warning("Admin notifier not running; dropped: %s", text.split("\n", 1)[0])
+        return
+    _ADMIN_Q.put_nowait((text, pics or []))
+
+def _join_admin_texts(texts: List[str]) -> List[str]:
+    chunks: List[str] = []
+    cur = ""
+    for text in texts:
+        joined = f"{cur}\n\n{text}" if cur else text
+        if cur and len(joined) > ADMIN_MSG_LIMIT:
+            chunks.append(cur)
+            cur = text
+        else:
+            cur = joined
+    chunks.append(cur)
+    return [c[:ADMIN_MSG_LIMIT] for c in chunks]
+
+async def _send_admin_texts(bot, texts: List[str]) -> None:
+    for chunk in _join_admin_texts(texts):
+        try:
+            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=chunk)
+        except Exception as e:
+            log.error("Admin notify failed: %s", e)
+
+async def _send_admin_batch(bot, batch: List[Tuple[str, List[str]]]) -> None:
+    texts: List[str] = []
+    for text, pics in batch:
+        if not pics:
+            texts.append(text)
+            continue
+        if texts:
+            await _send_admin_texts(bot, texts)
+            texts = []
+        await _send_admin_texts(bot, [text])
+        try:
+            await bot.send_media_group(chat_id=ADMIN_CHAT_ID, media=[InputMediaPhoto(p) for p in pics[:10]])
+        except Exception as e:
+            log.warning("Admin media group failed: %s", e)
+    if texts:
+        await _send_admin_texts(bot, texts)
+
+async def _admin_notifier(bot, q: asyncio.Queue) -> None:
+    while True:
+        batch, stop = await collect_batch(q, ADMIN_COALESCE_MAX, ADMIN_COALESCE_WINDOW)
+        if batch:
+            await _send_admin_batch(bot, batch)
+        if stop:
+            return
+
+def start_admin_notifier(bot) -> None:
+    global _ADMIN_Q, _ADMIN_TASK
+    _ADMIN_Q = asyncio.Queue()
+    _ADMIN_TASK = asyncio.create_task(_admin_notifier(bot, _ADMIN_Q))
+
+async def stop_admin_notifier() -> None:
+    """Send whatever is still queued, then stop (needs the bot still connected)."""
+    global _ADMIN_Q, _ADMIN_TASK
+    if _ADMIN_TASK is None:
+        return
+    _ADMIN_Q.put_nowait(None)
+    try:
+        await _ADMIN_TASK
+    except Exception as e:
+        log.error("Admin notifier failed: %s", e)
+    _ADMIN_Q = _ADMIN_TASK = None
 
 def pkg_details_for_lang(pkg_name: str, lang: str) -> str:
     pkg = PACKAGES.get(pkg_name)
@@ -624,20 +1309,34 @@ def pkg_details_for_lang(pkg_name: str, lang: str) -> str:
     return pkg["details_ar"] if lang == "ar" else pkg["details_en"]
 
 def _is_admin(user_id: int) -> bool:
-    try:
-        return ADMIN_CHAT_ID is not None and int(ADMIN_CHAT_ID) == int(user_id)
-    except Exception:
-        return False
+    # ADMIN_CHAT_ID is already an int (or None) from env_int.
+    return ADMIN_CHAT_ID is not None and user_id == ADMIN_CHAT_ID
 
 def _fmt_offer(o: dict, lang: str) -> str:
-    title = o["title_ar"] if lang == "ar" else o["title_en"]
-    s_uae = _parse_iso(o["start_at"]).astimezone(DUBAI_TZ).strftime("%Y-%m-%d %H:%M:%S")
-    e_uae = _parse_iso(o["end_at"]).astimezone(DUBAI_TZ).strftime("%Y-%m-%d %H:%M:%S")
-    return f"• {title}\n  🕒 {s_uae} → {e_uae} (UAE)"
+    """Admin summary line for an offer; memoised on the offer dict per language."""
+    key = "_line_" + lang
+    line = o.get(key)
+    if line is None:
+        line = o[key] = f"• {o['_title'][lang]}\n  🕒 {o['_window_uae']} (UAE)"
+    return line
+
+def _offer_view_text(o: dict, lang: str) -> str:
+    """Offer detail shown on offer_act; memoised on the offer dict like _fmt_offer."""
+    key = "_view_" + lang
+    text = o.get(key)
+    if text is None:
+        # Add note that offers may change at any time (already in body)
+        text = o[key] = (f"🛍️ <b>{o['_title'][lang]}</b>\n\n{o['_body'][lang]}\n\n"
+                         f"{STRINGS[lang]['terms']}\n\nPlease choose a package:")
+    return text
+
+def _offers_text(header: str, offers: List[Dict[str, Any]], lang: str) -> str:
+    return "\n".join([header, *(_fmt_offer(o, lang) for o in offers)])
 
-async def _send_phone_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Single, non-duplicated phone prompt."""
-    await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "phone_request"), reply_markup=phone_request_kb(chat_id))
+async def _send_phone_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id: int, st: Optional[Dict[str, Any]] = None):
+    """Single, non-duplicated phone prompt. Pass `st` when the caller already holds the chat state."""
+    lang = (st if st is not None else get_state(chat_id)).get("lang", "ar")
+    await context.bot.send_message(chat_id=chat_id, text=STRINGS[lang]["phone_request"], reply_markup=PHONE_KB[lang])
 
 # ------------------------- FLOWS (post-phone continuation) -------------------------
 async def _post_phone_continuations(update: Update, context: ContextTypes.DEFAULT_TYPE, phone: str):
@@ -666,41 +1365,33 @@ async def _post_phone_continuations(update: Update, context: ContextTypes.DEFAUL
     # TRIAL (per phone PER PACKAGE cooldown 30d)
     if reason == "trial":
         pkg = st.get("trial_pkg")
-        last_ok = None
-        for r in iter_jsonl(TRIALS_FILE):
-            if r.get("phone") == phone and r.get("package") == pkg:
-                try:
-                    when = datetime.fromisoformat(r.get("created_at"))
-                except Exception:
-                    when = _now_uae()
-                if not last_ok or when > last_ok:
-                    last_ok = when
+        last_ok = last_trial(phone, pkg)
         if last_ok and (_now_uae() - last_ok) < timedelta(days=30):
             days_left = 30 - (_now_uae() - last_ok).days
-            msg = I18N["trial_cooldown"]["ar" if get_state(chat_id).get("lang", "ar") == "ar" else "en"].format(pkg=pkg, days=days_left)
+            msg = STRINGS[st.get("lang", "ar")]["trial_cooldown"].format(pkg=pkg, days=days_left)
             await update.message.reply_text(msg, reply_markup=main_menu_kb(chat_id))
             set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None, trial_pkg=None)
             return
 
         hours = PACKAGES[pkg]["trial_hours"] if pkg in PACKAGES else 0
+        u = update.effective_user
+        created = _now_uae()
         tid = save_jsonl(TRIALS_FILE, {
             "tg_chat_id": chat_id,
-            "tg_user_id": update.effective_user.id,
-            "tg_username": update.effective_user.username,
+            "tg_user_id": u.id,
+            "tg_username": u.username,
             "phone": phone,
             "package": pkg,
             "trial_hours": hours,
-            "created_at": _now_uae().isoformat(),
+            "created_at": created,
             "status": "open"
         })
+        record_trial(phone, pkg, created)
         await update.message.reply_text(t(chat_id, "trial_recorded"), reply_markup=main_menu_kb(chat_id))
         if ADMIN_CHAT_ID:
-            await context.bot.send_message(
-                chat_id=int(ADMIN_CHAT_ID),
-                text=(f"🧪 NEW TRIAL REQUEST\nTicket #{tid}\n"
-                      f"User: @{update.effective_user.username or 'N/A'} ({update.effective_user.id})\n"
-                      f"Phone: {phone}\nPackage: {pkg}\nHours: {hours}")
-            )
+            notify_admin(f"🧪 NEW TRIAL REQUEST\nTicket #{tid}\n"
+                         f"User: @{u.username or 'N/A'} ({u.id})\n"
+                         f"Phone: {phone}\nPackage: {pkg}\nHours: {hours}")
         set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None, trial_pkg=None)
         return
 
@@ -736,10 +1427,8 @@ async def offers_now_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not acts:
         await update.message.reply_text("no offer")
         return
-    lines = ["Available offers now:"]
-    for o in acts:
-        lines.append(_fmt_offer(o, get_state(update.effective_chat.id).get("lang","ar")))
-    await update.message.reply_text("\n".join(lines))
+    lang = get_lang(update.effective_chat.id)
+    await update.message.reply_text(_offers_text("Available offers now:", acts, lang))
 
 async def upcoming_offers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_user.id):
@@ -749,17 +1438,21 @@ async def upcoming_offers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not ups:
         await update.message.reply_text("no offer")
         return
-    lines = ["Upcoming offers:"]
-    for o in ups:
-        lines.append(_fmt_offer(o, get_state(update.effective_chat.id).get("lang","ar")))
-    await update.message.reply_text("\n".join(lines))
+    lang = get_lang(update.effective_chat.id)
+    await update.message.reply_text(_offers_text("Upcoming offers:", ups, lang))
 
 async def offer_reload_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_user.id):
         await update.message.reply_text("⛔️ Admin only.")
         return
     global OFFERS_ALL
-    OFFERS_ALL = build_embedded_offers()
+    fresh = build_embedded_offers()
+    # Only swap when something changed, so the offer index and memoised
+    # summary lines built for the current list stay valid.
+    if _offer_fields(fresh) == _offer_fields(OFFERS_ALL):
+        await update.message.reply_text("Offers reloaded (no changes).")
+        return
+    OFFERS_ALL = fresh
     await update.message.reply_text("Offers reloaded.")
 
 async def debug_id_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -773,8 +1466,7 @@ async def any_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Support details flow
     if context.user_data.get("support_stage") == "await_details":
-        context.user_data["support_details"] = txt
-        context.user_data["support_stage"] = "await_optional_screenshot"
+        context.user_data.update(support_details=txt, support_stage="await_optional_screenshot")
         await update.message.reply_text(t(chat_id, "support_detail_prompt"))
         return
 
@@ -784,29 +1476,24 @@ async def any_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         save_customer(chat_id, update.effective_user, st.get("package"), st.get("phone"), extra={"username_for_renew": txt})
         await update.message.reply_text(t(chat_id, "username_saved"))
         set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="renew")
-        await _send_phone_prompt(context, chat_id)
+        await _send_phone_prompt(context, chat_id, st)
         return
 
     # Phone capture by text
     if st.get("awaiting_phone") and txt:
         if PHONE_RE.match(txt):
             phone = normalize_phone(txt)
+            u = update.effective_user
             set_state(chat_id, phone=phone)
-            save_customer(chat_id, update.effective_user, st.get("package"), phone)
+            save_customer(chat_id, u, st.get("package"), phone)
             if ADMIN_CHAT_ID:
-                try:
-                    await context.bot.send_message(
-                        chat_id=ADMIN_CHAT_ID,
-                        text=(f"📞 Phone captured\n"
-                              f"User: @{update.effective_user.username or 'N/A'} (id: {update.effective_user.id})\n"
-                              f"Name: {update.effective_user.full_name}\n"
-                              f"Package: {st.get('package')}\n"
-                              f"Phone: {phone}\n"
-                              f"Reason: {st.get('awaiting_phone_reason')}")
-                    )
-                except Exception as e:
-                    logging.error("Admin notify (phone) failed: %s", e)
-            await update.message.reply_text(t(chat_id, "phone_saved"), reply_markup=ReplyKeyboardRemove())
+                notify_admin(f"📞 Phone captured\n"
+                             f"User: @{u.username or 'N/A'} (id: {u.id})\n"
+                             f"Name: {u.full_name}\n"
+                             f"Package: {st.get('package')}\n"
+                             f"Phone: {phone}\n"
+                             f"Reason: {st.get('awaiting_phone_reason')}")
+            await update.message.reply_text(t(chat_id, "phone_saved"), reply_markup=REMOVE_KB)
             await _post_phone_continuations(update, context, phone)
             set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
             return
@@ -826,70 +1513,60 @@ async def on_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     contact: Contact = update.message.contact
     phone = normalize_phone(contact.phone_number or "")
     st = get_state(chat_id)
+    u = update.effective_user
     set_state(chat_id, phone=phone)
-    save_customer(chat_id, update.effective_user, st.get("package"), phone)
+    save_customer(chat_id, u, st.get("package"), phone)
 
     if ADMIN_CHAT_ID:
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=(f"📞 Phone captured via Contact\n"
-                      f"User: @{update.effective_user.username or 'N/A'} (id: {update.effective_user.id})\n"
-                      f"Name: {update.effective_user.full_name}\n"
-                      f"Package: {st.get('package')}\n"
-                      f"Phone: {phone}\n"
-                      f"Reason: {st.get('awaiting_phone_reason')}")
-            )
-        except Exception as e:
-            logging.error("Admin notify (contact) failed: %s", e)
-
-    await update.message.reply_text(t(chat_id, "phone_saved"), reply_markup=ReplyKeyboardRemove())
+        notify_admin(f"📞 Phone captured via Contact\n"
+                     f"User: @{u.username or 'N/A'} (id: {u.id})\n"
+                     f"Name: {u.full_name}\n"
+                     f"Package: {st.get('package')}\n"
+                     f"Phone: {phone}\n"
+                     f"Reason: {st.get('awaiting_phone_reason')}")
+    await update.message.reply_text(t(chat_id, "phone_saved"), reply_markup=REMOVE_KB)
     await _post_phone_continuations(update, context, phone)
     set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
 
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
     if context.user_data.get("support_stage") == "await_optional_screenshot":
         photos = update.message.photo or []
         if photos:
-            best = photos[-1].file_id
-            context.user_data.setdefault("support_photos", []).append(best)
+            # file_unique_id is stable across re-sends/forwards of the same image,
+            # so a screenshot sent twice is only attached to the ticket once.
+            best = photos[-1]
+            seen = context.user_data.setdefault("support_photo_uids", set())
+            if best.file_unique_id not in seen:
+                seen.add(best.file_unique_id)
+                context.user_data.setdefault("support_photos", []).append(best.file_id)
         await update.message.reply_text("✅ Screenshot received. Send more or /done to submit.")
         return
 
 async def done_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     if context.user_data.get("support_stage") in ("await_details", "await_optional_screenshot"):
+        u = update.effective_user
         tid = save_jsonl(SUPPORT_FILE, {
             "tg_chat_id": chat_id,
-            "tg_user_id": update.effective_user.id,
-            "tg_username": update.effective_user.username,
+            "tg_user_id": u.id,
+            "tg_username": u.username,
             "details": context.user_data.get("support_details"),
             "photos": context.user_data.get("support_photos", []),
-            "created_at": _now_uae().isoformat(),
+            "created_at": _now_uae(),
             "status": "open",
             "issue_code": context.user_data.get("support_issue_code"),
         })
         if ADMIN_CHAT_ID:
             pics = context.user_data.get("support_photos", [])
-            text = (f"🛟 NEW SUPPORT TICKET\n"
-                    f"Ticket #{tid}\n"
-                    f"Issue: {context.user_data.get('support_issue_code')}\n"
-                    f"User: @{update.effective_user.username or 'N/A'} ({update.effective_user.id})\n"
-                    f"Details: {context.user_data.get('support_details')}\n"
-                    f"Photos: {len(pics)}")
-            await context.bot.send_message(chat_id=int(ADMIN_CHAT_ID), text=text)
-            if pics:
-                media = [InputMediaPhoto(p) for p in pics[:10]]
-                try:
-                    await context.bot.send_media_group(chat_id=int(ADMIN_CHAT_ID), media=media)
-                except Exception:
-                    pass
+            notify_admin(f"🛟 NEW SUPPORT TICKET\n"
+                         f"Ticket #{tid}\n"
+                         f"Issue: {context.user_data.get('support_issue_code')}\n"
+                         f"User: @{u.username or 'N/A'} ({u.id})\n"
+                         f"Details: {context.user_data.get('support_details')}\n"
+                         f"Photos: {len(pics)}", pics)
         # clear stages then ask phone
-        context.user_data["support_stage"] = None
-        context.user_data["support_details"] = None
-        context.user_data["support_photos"] = []
-        context.user_data["support_issue_code"] = None
+        context.user_data.update(support_stage=None, support_details=None, support_photos=[],
+                                 support_photo_uids=set(), support_issue_code=None)
 
         set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="support")
         await _send_phone_prompt(context, chat_id)
@@ -897,307 +1574,401 @@ async def done_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(t(chat_id, "welcome"), reply_markup=main_menu_kb(chat_id))
 
 # Callback buttons
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    await q.answer()
-    chat_id = q.message.chat.id
-    user = q.from_user
-    data = (q.data or "").strip()
-    st = get_state(chat_id)
+async def _h_lang(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    lang = sys.intern(payload) if payload in STRINGS else "ar"
+    set_state(chat_id, lang=lang, awaiting_phone=False, awaiting_phone_reason=None,
+              awaiting_username=False, awaiting_username_reason=None, flow=None, trial_pkg=None)
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
 
-    if data.startswith("lang|"):
-        _, lang = data.split("|", 1)
-        if lang not in ("ar", "en"):
-            lang = "ar"
-        set_state(chat_id, lang=lang, awaiting_phone=False, awaiting_phone_reason=None,
-                  awaiting_username=False, awaiting_username_reason=None, flow=None, trial_pkg=None)
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
-        return
+async def _h_back_home(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None,
+              awaiting_username=False, awaiting_username_reason=None, flow=None)
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
 
-    if "lang" not in st:
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "pick_lang"), lang_kb())
-        return
+# ===== More Info (summary + links) =====
+async def _h_more_info(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    text = t(chat_id, "more_info_title") + "\n\n" + t(chat_id, "more_info_body_compact")
+    await safe_edit_or_send(q, context, chat_id, text, more_info_summary_kb(chat_id), no_preview=True)
 
-    if data == "back_home":
-        set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None,
-                  awaiting_username=False, awaiting_username_reason=None, flow=None)
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
-        return
+async def _h_players_links(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "players_links_title"), players_links_kb(chat_id))
 
-    # ===== More Info (summary + links) =====
-    if data == "more_info":
-        text = t(chat_id, "more_info_title") + "\n\n" + t(chat_id, "more_info_body_compact")
-        await safe_edit_or_send(q, context, chat_id, text, more_info_summary_kb(chat_id), no_preview=True)
+async def _h_player_links(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    which = payload
+    if which == "iplay":
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_iplay_body"), players_links_kb(chat_id))
         return
-
-    if data == "players_links":
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "players_links_title"), players_links_kb(chat_id))
+    if which == "splayer":
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_splayer_body"), players_links_kb(chat_id))
         return
-
-    if data.startswith("player_links|"):
-        _, which = data.split("|", 1)
-        if which == "iplay":
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_iplay_body"), players_links_kb(chat_id))
-            return
-        if which == "splayer":
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_splayer_body"), players_links_kb(chat_id))
-            return
-        if which == "000":
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_000_body"), players_links_kb(chat_id))
-            return
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "players_links_title"), players_links_kb(chat_id))
+    if which == "000":
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "player_000_body"), players_links_kb(chat_id))
         return
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "players_links_title"), players_links_kb(chat_id))
 
-    # Subscribe
-    if data == "subscribe":
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "subscribe_pick"), packages_kb())
-        set_state(chat_id, flow="subscribe")
-        return
+# Subscribe / Renew
+async def _h_subscribe(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "subscribe_pick"), packages_kb())
+    set_state(chat_id, flow="subscribe")
 
-    # Renew
-    if data == "renew":
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "subscribe_pick"), packages_kb())
-        set_state(chat_id, flow="renew")
-        return
+async def _h_renew(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "subscribe_pick"), packages_kb())
+    set_state(chat_id, flow="renew")
 
-    # Trial
-    if data == "trial":
-        set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "trial_pick"), trial_packages_kb())
-        return
+# Trial
+async def _h_trial(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "trial_pick"), trial_packages_kb())
 
-    if data.startswith("trial_pkg|"):
-        _, pkg_name = data.split("|", 1)
-        if pkg_name not in PACKAGES:
-            await safe_edit_or_send(q, context, chat_id, "Package not found.", trial_packages_kb())
-            return
-        set_state(chat_id, trial_pkg=pkg_name, awaiting_phone=True, awaiting_phone_reason="trial")
-        await _send_phone_prompt(context, chat_id)
+async def _h_trial_pkg(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    pkg_name = payload
+    if pkg_name not in PACKAGES:
+        await safe_edit_or_send(q, context, chat_id, "Package not found.", trial_packages_kb())
         return
+    set_state(chat_id, trial_pkg=pkg_name, awaiting_phone=True, awaiting_phone_reason="trial")
+    await _send_phone_prompt(context, chat_id)
 
-    # Support
-    if data == "support":
-        set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "support_pick"), support_issues_kb(chat_id))
+# Support
+async def _drop_keyboard(q) -> None:
+    try:
+        await q.edit_message_reply_markup(reply_markup=None)
+    except Exception as e:
+        log.debug("Keyboard removal failed: %s", e)
+
+async def _h_support(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    set_state(chat_id, awaiting_phone=False, awaiting_phone_reason=None)
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "support_pick"), support_issues_kb(chat_id))
+
+async def _h_support_issue(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    # Avoid duplicate prompt; on_button already told the user in its ack.
+    if context.user_data.get("support_stage") in ("await_details", "await_optional_screenshot"):
         return
 
-    if data.startswith("support_issue|"):
-        # Avoid duplicate prompt
-        if context.user_data.get("support_stage") in ("await_details", "await_optional_screenshot"):
-            await q.answer("Support ticket already open. Please describe the issue or send /done.")
-            return
+    user = q.from_user
+    code = payload
+    tid = save_jsonl(SUPPORT_FILE, {
+        "tg_chat_id": chat_id,
+        "tg_user_id": user.id,
+        "tg_username": user.username,
+        "issue_code": code,
+        "status": "open",
+        "created_at": _now_uae(),
+    })
+    context.user_data.update(support_ticket_seed=tid, support_issue_code=code, support_stage="await_details",
+                             support_details=None, support_photos=[], support_photo_uids=set())
 
-        _, code = data.split("|", 1)
-        tid = save_jsonl(SUPPORT_FILE, {
-            "tg_chat_id": chat_id,
-            "tg_user_id": user.id,
-            "tg_username": user.username,
-            "issue_code": code,
-            "status": "open",
-            "created_at": _now_uae().isoformat(),
-        })
-        context.user_data["support_ticket_seed"] = tid
-        context.user_data["support_issue_code"] = code
-        context.user_data["support_stage"] = "await_details"
+    LAST_MSG.pop(chat_id, None)
+    # Dropping the old keyboard is cosmetic; don't hold the prompt back for it.
+    context.application.create_task(_drop_keyboard(q))
+    await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "support_detail_prompt"))
 
-        try:
-            await q.edit_message_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "support_detail_prompt"))
+    if ADMIN_CHAT_ID:
+        notify_admin(f"🛟 SUPPORT OPENED (seed #{tid})\nIssue: {code}\n"
+                     f"User: @{user.username or 'N/A'} ({user.id})")
 
-        if ADMIN_CHAT_ID:
-            await context.bot.send_message(
-                chat_id=int(ADMIN_CHAT_ID),
-                text=(f"🛟 SUPPORT OPENED (seed #{tid})\nIssue: {code}\n"
-                      f"User: @{user.username or 'N/A'} ({user.id})")
-            )
-        return
+# Offers
+def _offer_idx(s: str, default: Optional[int] = None) -> Optional[int]:
+    """Offer index from callback data; plain ASCII digits only, no exception path."""
+    return int(s) if s.isascii() and s.isdigit() else default
 
-    # Offers
-    if data == "offers":
-        acts = active_offers()
-        if not acts:
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"),
-                                    InlineKeyboardMarkup([[InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")]]))
-            return
-        rows = []
-        for idx, o in enumerate(acts):
-            title = o["title_ar"] if get_state(chat_id).get("lang","ar")=="ar" else o["title_en"]
-            rows.append([InlineKeyboardButton(title, callback_data=f"offer_act|{idx}")])
-        rows.append([InlineKeyboardButton(t(chat_id, "btn_back"), callback_data="back_home")])
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_title"), InlineKeyboardMarkup(rows))
+async def _h_offers(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    acts = active_offers()
+    if not acts:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), back_home_kb(chat_id))
         return
+    lang = get_lang(chat_id)
+    await safe_edit_or_send(q, context, chat_id, STRINGS[lang]["offers_title"], offers_list_kb(lang, acts))
 
-    if data.startswith("offer_act|"):
-        _, sidx = data.split("|", 1)
-        try:
-            idx = int(sidx)
-        except Exception:
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-        acts = active_offers()
-        if idx < 0 or idx >= len(acts):
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-        off = acts[idx]
-        now = _utcnow()
-        if not (_parse_iso(off["start_at"]) <= now <= _parse_iso(off["end_at"])):
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-        lang = get_state(chat_id).get("lang", "ar")
-        title = off["title_ar"] if lang == "ar" else off["title_en"]
-        body  = off["body_ar"]  if lang == "ar" else off["body_en"]
-        # Add note that offers may change at any time (already in body)
-        text = f"🛍️ <b>{title}</b>\n\n{body}\n\n{t(chat_id, 'terms')}\n\nPlease choose a package:"
-        await safe_edit_or_send(q, context, chat_id, text, offer_packages_kb(idx), html=True)
+async def _h_offer_act(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    idx = _offer_idx(payload)
+    if idx is None:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
+        return
+    acts = active_offers()
+    if idx < 0 or idx >= len(acts):
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
+        return
+    off = acts[idx]
+    now = _utcnow()
+    if not (off["_start_dt"] <= now <= off["_end_dt"]):
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
+        return
+    lang = get_lang(chat_id)
+    await safe_edit_or_send(q, context, chat_id, _offer_view_text(off, lang), offer_packages_kb(idx), html=True)
+
+# user chooses which package inside the selected offer
+async def _h_offer_pkg(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    sidx, sep, pkg_key = payload.partition("|")
+    if not sep:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
+        return
+    idx = _offer_idx(sidx)
+    if idx is None:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
         return
 
-    # user chooses which package inside the selected offer
-    if data.startswith("offer_pkg|"):
-        parts = data.split("|", 2)
-        if len(parts) != 3:
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-        _, sidx, pkg_key = parts
-        try:
-            idx = int(sidx)
-        except Exception:
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-
-        acts = active_offers()
-        if idx < 0 or idx >= len(acts):
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
+    acts = active_offers()
+    if idx < 0 or idx >= len(acts):
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
+        return
 
-        off = acts[idx]
-        ctas: Dict[str, str] = off.get("cta_urls", {})
-        url = ctas.get(pkg_key, "")
+    off = acts[idx]
+    if not off.get("cta_urls", {}).get(pkg_key):
+        await safe_edit_or_send(q, context, chat_id, "Payment link not available for this package.", offer_packages_kb(idx))
+        return
 
-        if not url:
-            await safe_edit_or_send(q, context, chat_id, "Payment link not available for this package.", offer_packages_kb(idx))
-            return
+    lang = get_lang(chat_id)
+    await safe_edit_or_send(q, context, chat_id, STRINGS[lang]["payment_instructions"],
+                            offer_pay_kb(off, idx, pkg_key, lang), no_preview=True)
 
-        await safe_edit_or_send(
-            q, context, chat_id, t(chat_id, "payment_instructions"),
-            InlineKeyboardMarkup([
-                [InlineKeyboardButton(t(chat_id, "btn_pay_now"), url=url)],
-                [InlineKeyboardButton(t(chat_id, "btn_paid"), callback_data=f"offer_paid|{idx}|{pkg_key}")],
-                [InlineKeyboardButton("⬅️ Back", callback_data=f"offer_act|{idx}")]
-            ]),
-            no_preview=True
-        )
+# Back-compat: if old flow sends offer_agree, route to package picker
+async def _h_offer_agree(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    idx = _offer_idx(payload)
+    if idx is None:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
         return
+    await safe_edit_or_send(q, context, chat_id, "Choose a package:", offer_packages_kb(idx))
 
-    # Back-compat: if old flow sends offer_agree, route to package picker
-    if data.startswith("offer_agree|"):
-        _, sidx = data.split("|", 1)
-        try:
-            idx = int(sidx)
-        except Exception:
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-        await safe_edit_or_send(q, context, chat_id, "Choose a package:", offer_packages_kb(idx))
+async def _h_offer_paid(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    sidx, sep, pkg_key = payload.partition("|")
+    if "|" in pkg_key:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
         return
 
-    if data.startswith("offer_paid|"):
-        parts = data.split("|")
-        if len(parts) not in (2, 3):
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
-
-        idx = int(parts[1]) if parts[1].isdigit() else -1
-        pkg_key = parts[2] if len(parts) == 3 else "Offer"
-
-        acts = active_offers()
-        if idx < 0 or idx >= len(acts):
-            await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
-            return
+    user = q.from_user
+    idx = _offer_idx(sidx, -1)
+    if not sep:
+        pkg_key = "Offer"
 
-        ts = _now_uae().strftime("%Y-%m-%d %H:%M:%S")
-        await context.bot.send_message(chat_id=chat_id,
-                                       text=t(chat_id, "breadcrumb_paid").format(pkg=pkg_key, ts=ts))
-        set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="offer")
-        await _send_phone_prompt(context, chat_id)
-        if ADMIN_CHAT_ID:
-            await context.bot.send_message(chat_id=int(ADMIN_CHAT_ID),
-                                           text=(f"🆕 Offer I Paid (phone pending)\n"
-                                                 f"User: @{user.username or 'N/A'} ({user.id})\n"
-                                                 f"Offer index: {idx}\n"
-                                                 f"Package: {pkg_key}"))
+    acts = active_offers()
+    if idx < 0 or idx >= len(acts):
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "offers_none"), main_menu_kb(chat_id))
         return
 
-    # Package selection (subscribe/renew)
-    if data.startswith("pkg|"):
-        _, pkg_name = data.split("|", 1)
-        if pkg_name not in PACKAGES:
-            await safe_edit_or_send(q, context, chat_id, "Package not found.", packages_kb())
-            return
-        set_state(chat_id, package=pkg_name)
-        price = PACKAGES[pkg_name]["price_aed"]
-        await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "breadcrumb_sel").format(pkg=pkg_name, price=price))
-        lang = get_state(chat_id).get("lang", "ar")
-        details = pkg_details_for_lang(pkg_name, lang)
-        flow = get_state(chat_id).get("flow", "subscribe")
-        text = f"🛍️ <b>{pkg_name}</b>\n💰 <b>{price} AED</b>\n{details}\n{t(chat_id, 'terms')}"
-        await safe_edit_or_send(q, context, chat_id, text, agree_kb(chat_id, pkg_name, flow), html=True)
+    ts = _uae_stamp("%Y-%m-%d %H:%M:%S")
+    set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="offer")
+    await context.bot.send_message(chat_id=chat_id,
+                                   text=t(chat_id, "breadcrumb_paid").format(pkg=pkg_key, ts=ts))
+    await _send_phone_prompt(context, chat_id)
+    if ADMIN_CHAT_ID:
+        notify_admin(f"🆕 Offer I Paid (phone pending)\n"
+                     f"User: @{user.username or 'N/A'} ({user.id})\n"
+                     f"Offer index: {idx}\n"
+                     f"Package: {pkg_key}")
+
+# Package selection (subscribe/renew)
+async def _h_pkg(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    pkg_name = payload
+    if pkg_name not in PACKAGES:
+        await safe_edit_or_send(q, context, chat_id, "Package not found.", packages_kb())
         return
-
-    if data.startswith("agree|"):
-        _, reason, pkg_name = data.split("|", 2)
-        await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "breadcrumb_agree").format(pkg=pkg_name))
-        await safe_edit_or_send(q, context, chat_id, t(chat_id, "payment_instructions"), pay_kb(chat_id, pkg_name, reason), no_preview=True)
+    set_state(chat_id, package=pkg_name)
+    st = get_state(chat_id)
+    lang = get_lang(chat_id)
+    s = STRINGS[lang]
+    price = PACKAGES[pkg_name]["price_aed"]
+    await context.bot.send_message(chat_id=chat_id, text=s["breadcrumb_sel"].format(pkg=pkg_name, price=price))
+    details = pkg_details_for_lang(pkg_name, lang)
+    flow = st.get("flow", "subscribe")
+    text = f"🛍️ <b>{pkg_name}</b>\n💰 <b>{price} AED</b>\n{details}\n{s['terms']}"
+    await safe_edit_or_send(q, context, chat_id, text, agree_kb(chat_id, pkg_name, flow), html=True)
+
+async def _h_agree(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    reason, _, pkg_name = payload.partition("|")
+    if pkg_name not in PACKAGES:
+        await safe_edit_or_send(q, context, chat_id, "Package not found.", packages_kb())
         return
+    s = STRINGS[get_lang(chat_id)]
+    await context.bot.send_message(chat_id=chat_id, text=s["breadcrumb_agree"].format(pkg=pkg_name))
+    await safe_edit_or_send(q, context, chat_id, s["payment_instructions"], pay_kb(chat_id, pkg_name, reason), no_preview=True)
 
-    if data.startswith("paid|"):
-        _, reason, pkg_name = data.split("|", 2)
-        ts = _now_uae().strftime("%Y-%m-%d %H:%M:%S")
-        await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "breadcrumb_paid").format(pkg=pkg_name, ts=ts))
+async def _h_paid(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    user = q.from_user
+    reason, _, pkg_name = payload.partition("|")
+    ts = _uae_stamp("%Y-%m-%d %H:%M:%S")
+    if reason == "renew":
+        set_state(chat_id, awaiting_username=True, awaiting_username_reason="renew")
+    else:
+        set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="subscribe")
 
-        if reason == "renew":
-            set_state(chat_id, awaiting_username=True, awaiting_username_reason="renew")
-            await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "ask_username"))
-        else:
-            set_state(chat_id, awaiting_phone=True, awaiting_phone_reason="subscribe")
-            await _send_phone_prompt(context, chat_id)
+    if ADMIN_CHAT_ID:
+        notify_admin(f"🧾 I Paid clicked\n"
+                     f"User: @{user.username or 'N/A'} (id: {user.id})\n"
+                     f"Package: {pkg_name}\n"
+                     f"Reason: {reason}\n"
+                     f"Phone: pending")
+    await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "breadcrumb_paid").format(pkg=pkg_name, ts=ts))
+    if reason == "renew":
+        await context.bot.send_message(chat_id=chat_id, text=t(chat_id, "ask_username"))
+    else:
+        await _send_phone_prompt(context, chat_id)
 
-        if ADMIN_CHAT_ID:
-            await context.bot.send_message(
-                chat_id=int(ADMIN_CHAT_ID),
-                text=(f"🧾 I Paid clicked\n"
-                      f"User: @{user.username or 'N/A'} (id: {user.id})\n"
-                      f"Package: {pkg_name}\n"
-                      f"Reason: {reason}\n"
-                      f"Phone: pending")
-            )
+async def _h_fallback(q, context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: str) -> None:
+    await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
+
+# callback_data is "<prefix>" or "<prefix>|<payload>"; one dict lookup picks the handler.
+CB_HANDLERS: Dict[str, Callable[[Any, ContextTypes.DEFAULT_TYPE, int, str], Awaitable[None]]] = {
+    "lang": _h_lang,
+    "back_home": _h_back_home,
+    "more_info": _h_more_info,
+    "players_links": _h_players_links,
+    "player_links": _h_player_links,
+    "subscribe": _h_subscribe,
+    "renew": _h_renew,
+    "trial": _h_trial,
+    "trial_pkg": _h_trial_pkg,
+    "support": _h_support,
+    "support_issue": _h_support_issue,
+    "offers": _h_offers,
+    "offer_act": _h_offer_act,
+    "offer_pkg": _h_offer_pkg,
+    "offer_agree": _h_offer_agree,
+    "offer_paid": _h_offer_paid,
+    "pkg": _h_pkg,
+    "agree": _h_agree,
+    "paid": _h_paid,
+}
+
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    chat_id = q.message.chat.id
+    data = (q.data or "").strip()
+    key, _, payload = data.partition("|")
+    # Ack in the background so the spinner clears while we render; a failed ack
+    # reaches handle_error through the application. This is the query's only
+    # answer, so a notice for the user has to go in it rather than a second one.
+    notice = None
+    if key == "support_issue" and context.user_data.get("support_stage") in ("await_details", "await_optional_screenshot"):
+        notice = "Support ticket already open. Please describe the issue or send /done."
+    context.application.create_task(q.answer(notice), update=update)
+
+    # New chats must pick a language first; answer them before any other work.
+    if key != "lang" and chat_id not in CHAT_LANG:
+        await safe_edit_or_send(q, context, chat_id, t(chat_id, "pick_lang"), lang_kb())
         return
 
-    # Fallback
-    await safe_edit_or_send(q, context, chat_id, t(chat_id, "welcome"), main_menu_kb(chat_id))
+    if key in CALLBACK_DEDUP_PREFIXES and seen_recently(chat_id, data):
+        return
+
+    handler = CB_HANDLERS.get(key, _h_fallback)
+    await handler(q, context, chat_id, payload)
 
 # ------------------------- ERROR HANDLER -------------------------
 async def handle_error(update: Optional[Update], context: ContextTypes.DEFAULT_TYPE):
-    logging.exception("Handler error: %s", context.error)
+    log.exception("Handler error: %s", context.error)
 
 # ------------------------- STARTUP -------------------------
 async def _post_init(application: Application):
-    try:
-        if WEBHOOK_URL:
-            await application.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
-        else:
-            await application.bot.delete_webhook(drop_pending_updates=True)
-    except Exception as e:
-        logging.warning("Webhook init/cleanup failed: %s", e)
+    # No webhook calls here: run_webhook/run_polling already set or delete it
+    # (with the secret) when the updater starts.
+    start_persist_writer()
+    start_state_flusher()
+    start_admin_notifier(application.bot)
+
+async def _post_stop(application: Application):
+    # post_stop still has a connected bot; post_shutdown runs after it is closed.
+    await stop_admin_notifier()
+
+async def _post_shutdown(application: Application):
+    await stop_state_flusher()
+    await stop_persist_writer()
 
 # ------------------------- MAIN -------------------------
+# Outgoing calls are paced by PTB's AIORateLimiter: at most BOT_RATE_PER_SEC
+# bot-wide, and on RetryAfter the call sleeps as told and is retried.
+BOT_RATE_PER_SEC = 30
+BOT_RATE_RETRIES = 3
+
+# Only messages and button presses have handlers; Telegram is asked not to send
+# anything else (edits, channel posts, member updates, ...).
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def _rate_limiter() -> Optional[AIORateLimiter]:
+    try:
+        return AIORateLimiter(overall_max_rate=BOT_RATE_PER_SEC, overall_time_period=1,
+                              max_retries=BOT_RATE_RETRIES)
+    except RuntimeError as e:  # needs python-telegram-bot[rate-limiter]
+        log.warning("Rate limiter unavailable: %s", e)
+        return None
+
+# At most LOG_QUEUE_MAX records wait for the listener; past that (an error storm)
+# records are dropped and counted rather than blocking or growing without bound.
+LOG_QUEUE_MAX = 10000
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge %-args now (they may change later), but leave exc_info for the
+        # listener: the stock prepare() would format the traceback on this thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": log.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "Log queue full; dropped %s records" % self.dropped,
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # The stock put_nowait() raises queue.Full if the queue is full at exit;
+        # the listener thread is still draining, so wait for room instead.
+        self.queue.put(self._sentinel)
+
+def _setup_logging(level: int = logging.INFO) -> None:
+    """Handlers only enqueue records; a listener thread formats and writes them."""
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_MAX)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    listener = _LogListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+
 def main():
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    _setup_logging()
 
     global OFFERS_ALL
     OFFERS_ALL = build_embedded_offers()
+    load_state()
+    load_update_checkpoint()
+    log.info("Indexed trials for %s phone/package pairs", len(_trial_index()))
+    # Everything built so far (strings, keyboards, offers, state) lives for the
+    # whole process; move it out of the collector's generations so periodic
+    # collections only scan what handlers allocate.
+    gc.freeze()
+
+    if uvloop is not None:
+        uvloop.install()
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(256)
+        .pool_timeout(3.0)
+        .connect_timeout(3.0)
+        .read_timeout(10.0)
+        .write_timeout(10.0)
+        .http_version("2" if h2 is not None else "1.1")
+        .rate_limiter(_rate_limiter())
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
-    app = Application.builder().token(BOT_TOKEN).post_init(_post_init).build()
+    app.add_handler(TypeHandler(Update, skip_seen_update), group=-1)
 
     # Commands
     app.add_handler(CommandHandler("start", start))
@@ -1223,11 +1994,12 @@ def main():
 
     if WEBHOOK_URL:
         port = int(os.getenv("PORT", "10000"))
-        logging.info("Starting webhook on 0.0.0.0:%s with webhook_url=%s", port, WEBHOOK_URL)
-        app.run_webhook(listen="0.0.0.0", port=port, url_path="", webhook_url=WEBHOOK_URL, drop_pending_updates=True)
+        log.info("Starting webhook on 0.0.0.0:%s with webhook_url=%s", port, WEBHOOK_URL)
+        app.run_webhook(listen="0.0.0.0", port=port, url_path="", webhook_url=WEBHOOK_URL, drop_pending_updates=False,
+                        max_connections=100, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
     else:
-        logging.info("Starting polling.")
-        app.run_polling(allowed_updates=None, drop_pending_updates=True, close_loop=False)
+        log.info("Starting polling.")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=False, close_loop=False)
 
 if __name__ == "__main__":
     main()